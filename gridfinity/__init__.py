@@ -1,7 +1,17 @@
-import math
+import hashlib
+import multiprocessing
+import os
+import tempfile
 import warnings
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import repeat
 from typing import List, Union, Optional, Literal
-from dataclasses import dataclass
+from dataclasses import astuple, dataclass
+
+from OCP.BRepMesh import BRepMesh_IncrementalMesh
+
+from gridfinity._layout import compute_bucket_rects, compute_scoop_centers
 
 try:
     import cadquery2 as cq
@@ -13,6 +23,8 @@ except ImportError:
 BOTTOM_THICKNESS = 2
 BASE_HEIGHT = 5
 MATE_HEIGHT = 5
+# Part of the key of make_cached_gridfinity_box. Bump it whenever the drawing code changes the produced geometry.
+CACHE_VERSION = 2
 
 
 Divisions = List[Union[List[float], int]]
@@ -34,36 +46,38 @@ class CannotDrawLabelLedgesWarning(Warning):
     pass
 
 
-@dataclass
+@dataclass(frozen=True)
 class GridfinityDimension:
+    __slots__ = ('x', 'y', 'z', 'x_mm', 'y_mm', 'z_mm')
+
     x: int
     y: int
     z: int
 
-    @property
-    def x_mm(self) -> float:
-        return self.x * 42 - 0.5
-
-    @property
-    def y_mm(self) -> float:
-        return self.y * 42 - 0.5
-
-    @property
-    def z_mm(self) -> float:
-        return self.z * 7
-
     def __post_init__(self):
         if self.x < 1 or self.y < 1:
             raise InvalidPropertyError('Width or length cannot be less than 1.')
         if self.z < 2:
             raise InvalidPropertyError('Units high cannot be less than 2.')
 
+        object.__setattr__(self, 'x_mm', self.x * 42 - 0.5)
+        object.__setattr__(self, 'y_mm', self.y * 42 - 0.5)
+        object.__setattr__(self, 'z_mm', self.z * 7)
+
+    def __reduce__(self):
+        return self.__class__, (self.x, self.y, self.z)
+
     def __str__(self) -> str:
         return '{dimension.x}x{dimension.y}x{dimension.z}'.format(dimension=self)
 
 
 @dataclass
 class Properties:
+    __slots__ = (
+        'dimension', 'divisions', 'wall_thickness',
+        'draw_finger_scoop', 'draw_label_ledge', 'make_magnet_hole', 'make_screw_hole'
+    )
+
     dimension: GridfinityDimension
     divisions: Divisions
 
@@ -109,17 +123,19 @@ class Properties:
 
 
 def draw_bases(self: Workplane, dimension: GridfinityDimension, draw_magnet_holes: bool) -> Workplane:
+    base = _make_base_shape(draw_magnet_holes)
     return (
         self
         .rarray(42, 42, dimension.x, dimension.y)
-        .eachpoint(lambda loc: (
-            cq.Workplane()
-            .drawBase(draw_magnet_holes)
-            .val().located(loc)
-        ))
+        .eachpoint(lambda loc: base.located(loc))
     )
 
 
+@lru_cache(maxsize=None)
+def _make_base_shape(with_magnets: bool) -> cq.Shape:
+    return cq.Workplane().drawBase(with_magnets).val()
+
+
 def draw_base(
     self: Workplane,
     with_magnets: bool
@@ -148,88 +164,78 @@ def draw_magnet_holes(self: Workplane) -> Workplane:
 
 
 def draw_buckets(self: Workplane, dimension: GridfinityDimension, divisions: Divisions, wall_thickness: float) -> Workplane:
-    is_drawer_too_small = False
     small_drawer_width = 15
 
     buckets_height = dimension.z_mm - MATE_HEIGHT
 
-    sketches = []
-    x_origin, y_origin = (wall_thickness, wall_thickness)
-    for row in divisions:
-        if isinstance(row, int):
-            row = [1] * row
-
-        number_of_x_walls = len(row) + 1
-        buckets_x = [(ratio / sum(row)) * (dimension.x_mm - number_of_x_walls * wall_thickness) for ratio in row]
-        number_of_y_walls = len(divisions) + 1
-        bucket_y = (dimension.y_mm - number_of_y_walls * wall_thickness) / len(divisions)
-
-        for bucket_x in buckets_x:
-            sketch = draw_bucket_sketch(bucket_x, bucket_y, dimension.x_mm, dimension.y_mm, x_origin, y_origin,
-                                        wall_thickness, small_drawer_width)
-
-            x_origin = x_origin + bucket_x + wall_thickness
-            sketches.append(sketch)
-
-        x_origin = wall_thickness
-        y_origin = y_origin + bucket_y + wall_thickness
+    rows = [[1] * row if isinstance(row, int) else row for row in divisions]
+    rects = compute_bucket_rects(dimension.x_mm, dimension.y_mm, wall_thickness, rows)
 
+    is_drawer_too_small = any(bucket_x < small_drawer_width for _, _, bucket_x, _ in rects)
     if is_drawer_too_small:
         warnings.warn(
             f'Drawer width is less than or equal to {small_drawer_width}mm',
             SmallDimensionsWarning
         )
 
-    return (
-        self
-        .faces('<Z[0]').workplane(centerOption='CenterOfBoundBox').tag('base')
-        .box(dimension.x_mm, dimension.y_mm, buckets_height, (True, True, False))
-        .edges('|Z').fillet(3.75)
-        .faces('>Z')
-        .workplane()
-        .placeSketch(*sketches)
-        .extrude(wall_thickness - buckets_height, 'cut')
+    walls = (
+        cq.Sketch()
+        .rect(dimension.x_mm, dimension.y_mm)
+        .vertices()
+        .fillet(3.75)
+        .reset()
     )
 
+    centers_by_size = {}
+    for x_origin, y_origin, bucket_x, bucket_y in rects:
+        centers_by_size.setdefault((bucket_x, bucket_y), []).append((
+            -dimension.x_mm / 2 + x_origin + bucket_x / 2,
+            dimension.y_mm / 2 - y_origin - bucket_y / 2
+        ))
 
-def draw_bucket_sketch(x_mm: float, y_mm: float, support_x_mm: float, support_y_mm: float, x_origin: float,
-                       y_origin: float, wall_thickness: float, small_drawer_width: float) -> Sketch:
-    if x_mm < small_drawer_width:
-        warnings.warn(
-            f'Drawer width is less than or equal to {small_drawer_width}mm',
-            SmallDimensionsWarning
+    floors = cq.Sketch()
+    for (bucket_x, bucket_y), centers in centers_by_size.items():
+        bucket = (
+            cq.Sketch()
+            .rect(bucket_x, bucket_y)
+            .vertices()
+            .fillet(3.75 - wall_thickness)
         )
-    sketch = (
-        cq.Sketch()
-        .rect(x_mm, y_mm)
-        .vertices()
-        .fillet(3.75 - wall_thickness)
-        .edges()
-        .moved(Location(Vector(
-            x_mm / 2,
-            -y_mm / 2
-        )))
-        .moved(Location(Vector(
-            -support_x_mm / 2 + x_origin,
-            support_y_mm / 2 - y_origin
-        )))
+        walls = walls.push(centers).face(bucket, mode='s')
+        floors = floors.push(centers).face(bucket)
+
+    # The walls are extruded over the full height so that the outer sides of the box are single faces, the floors
+    # only fill the bottom of the buckets.
+    return (
+        self
+        .faces('<Z[0]').workplane(centerOption='CenterOfBoundBox').tag('base')
+        .placeSketch(walls)
+        .extrude(buckets_height)
+        .workplaneFromTagged('base')
+        .placeSketch(floors)
+        .extrude(wall_thickness)
     )
-    return sketch
 
 
 def draw_mate(self: Workplane, dimension: GridfinityDimension) -> Workplane:
     height = 2.4 + 1 + 1.6
 
+    lip = (
+        cq.Sketch()
+        .rect(dimension.x_mm, dimension.y_mm)
+        .rect(dimension.x_mm - 2 * 2.4 + 0.5, dimension.y_mm - 2 * 2.4 + 0.5, mode='s')
+        .vertices('not (<X or >X)').fillet(3.75 - 2.4 + 0.25)
+        .reset()
+        .vertices('<X or >X').fillet(3.75)
+    )
+
     top = (
         cq.Workplane().copyWorkplane(
             self.workplaneFromTagged('base')
             .workplane(offset=dimension.z_mm - height + 0.0001)
         )
-        .box(dimension.x_mm, dimension.y_mm, height, (True, True, False))
-        .edges('|Z').fillet(3.75)
-        .faces('>Z').sketch()
-        .rect(dimension.x_mm - 2 * 2.4 + 0.5, dimension.y_mm - 2 * 2.4 + 0.5)
-        .vertices().fillet(3.75 - 2.4 + 0.25).finalize().cutThruAll()
+        .placeSketch(lip)
+        .extrude(height)
         .faces('>Z').sketch()
         .rect(dimension.x_mm, dimension.y_mm)
         .vertices().fillet(3.75).finalize().cutThruAll(taper=45)
@@ -241,33 +247,19 @@ def draw_mate(self: Workplane, dimension: GridfinityDimension) -> Workplane:
 
 
 def draw_finger_scoops(self: Workplane, dimension: GridfinityDimension) -> Workplane:
-    bucket_length = (dimension.y_mm - (dimension.y + 1)*0.8) / dimension.y
-    scoop_radius = min(dimension.z_mm * 0.3, bucket_length * 0.9)
-
-    sketches = []
-    for i in range(0, dimension.y):
-        sketch = (
-            cq.Sketch()
-            .rect(scoop_radius, scoop_radius)
-            .vertices('>X and >Y')
-            .circle(scoop_radius, mode='s')
-            .moved(Location(Vector(
-                scoop_radius / 2 -
-                0.5 * bucket_length * dimension.y -
-                math.floor(dimension.y / 2) +
-                (0.5 if dimension.y % 2 == 0 else 0),
-                scoop_radius / 2 - (dimension.z_mm - BOTTOM_THICKNESS) / 2)))
-            .moved(Location(Vector(
-                i * (bucket_length + 1) + (1.6 if i == 0 else 0),
-                0
-            )))
-        )
-        sketches.append(sketch)
+    scoop_radius, centers = compute_scoop_centers(dimension.y, dimension.y_mm, dimension.z_mm, BOTTOM_THICKNESS)
+    scoop = (
+        cq.Sketch()
+        .rect(scoop_radius, scoop_radius)
+        .vertices('>X and >Y')
+        .circle(scoop_radius, mode='s')
+    )
+    sketch = cq.Sketch().push(centers).face(scoop)
 
     return (
         self.faces('>X[1]')
         .workplane(centerOption='CenterOfBoundBox')
-        .placeSketch(*sketches)
+        .placeSketch(sketch)
         .extrude(dimension.x_mm - 0.8)
     )
 
@@ -279,50 +271,53 @@ def draw_label_ledge(self: Workplane, dimension: GridfinityDimension, wall_thick
 
     max_ledge_height = dimension.z_mm - 5 - 5 - wall_thickness
 
-    last_offset = 0
-    ledge_height = min(max_ledge_height, ledge_length)
-
-    sketches = []
-    for i in range(0, dimension.y):
-
-        if i == dimension.y - 1:
-            last_offset = back_ledge_offset
-            ledge_height = min(max_ledge_height, ledge_length + last_offset)
-
-        sketch = (
-            cq.Sketch()
-            .segment((last_offset, -ledge_height), (last_offset, 0))
-            .segment((-ledge_length, 0))
-        )
-
-        if ledge_height < ledge_length:
-            sketch = sketch.segment(
-                (-ledge_length + ledge_height, -ledge_height))
-
-        sketch = (
-            sketch
-            .close()
-            .assemble()
-            .vertices('<X')
-            .fillet(0.6)
-            .moved(Location(Vector(
-                - 0.5 - (0.5 * dimension.y - 1) * (bucket_length + 1),
-                (dimension.z_mm - wall_thickness) / 2)))
-            .moved(Location(Vector(
-                i * (bucket_length + 1) - last_offset,
-                0
-            )))
+    centers = [
+        (
+            - 0.5 - (0.5 * dimension.y - 1) * (bucket_length + 1) + i * (bucket_length + 1),
+            (dimension.z_mm - wall_thickness) / 2
         )
-        sketches.append(sketch)
+        for i in range(0, dimension.y)
+    ]
+    back_x, back_y = centers.pop()
+
+    # Every row but the back one shares the same ledge, the back one reaches further into the back wall.
+    sketch = cq.Sketch()
+    if centers:
+        front_ledge = _draw_ledge_sketch(ledge_length, min(max_ledge_height, ledge_length), 0)
+        sketch = sketch.push(centers).face(front_ledge)
+    back_ledge = _draw_ledge_sketch(
+        ledge_length, min(max_ledge_height, ledge_length + back_ledge_offset), back_ledge_offset
+    )
+    sketch = sketch.push([(back_x - back_ledge_offset, back_y)]).face(back_ledge)
 
     return (
         self.faces('>X[1]')
         .workplane(centerOption='CenterOfBoundBox')
-        .placeSketch(*sketches)
+        .placeSketch(sketch)
         .extrude(dimension.x_mm - wall_thickness*2)
     )
 
 
+def _draw_ledge_sketch(ledge_length: float, ledge_height: float, offset: float) -> Sketch:
+    sketch = (
+        cq.Sketch()
+        .segment((offset, -ledge_height), (offset, 0))
+        .segment((-ledge_length, 0))
+    )
+
+    if ledge_height < ledge_length:
+        sketch = sketch.segment(
+            (-ledge_length + ledge_height, -ledge_height))
+
+    return (
+        sketch
+        .close()
+        .assemble()
+        .vertices('<X')
+        .fillet(0.6)
+    )
+
+
 def draw_screw_holes(self: Workplane) -> Workplane:
     self.plane.zDir = Vector(0, 0, -1)
 
@@ -353,9 +348,14 @@ def make_box(
                                   'SVG', 'TJS', 'DXF', 'VRML', 'VTP']] = None,
     tolerance: float = 0.1,
     angular_tolerance: float = 0.1,
-    opt=None
+    opt=None,
+    cache_dir: Union[str, None] = None,
+    parallel: bool = True
 ) -> Workplane:
-    box = make_gridfinity_box(cq.Workplane(), prop)
+    if cache_dir:
+        box = make_cached_gridfinity_box(prop, cache_dir)
+    else:
+        box = make_gridfinity_box(cq.Workplane(), prop)
 
     if out_file:
         export_box(
@@ -364,11 +364,61 @@ def make_box(
             export_type=export_type,
             tolerance=tolerance,
             angular_tolerance=angular_tolerance,
-            opt=opt
+            opt=opt,
+            parallel=parallel
         )
     return box
 
 
+def make_boxes(
+    props: List[Properties],
+    out_files: List[str],
+    export_type: Optional[Literal['STL', 'STEP', 'AMF',
+                                  'SVG', 'TJS', 'DXF', 'VRML', 'VTP']] = None,
+    tolerance: float = 0.1,
+    angular_tolerance: float = 0.1,
+    opt=None,
+    max_workers: Optional[int] = None
+) -> None:
+    if len(props) != len(out_files):
+        raise ValueError(
+            f'Got {len(props)} properties for {len(out_files)} output files, there must be one file per box.'
+        )
+
+    # Forked workers would inherit the state of OCC's thread pool without its threads, and hang on their first
+    # parallel mesh if the parent already meshed one. Spawned workers start clean and mesh on a single thread each.
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        # Consuming the results re-raises the first exception of a worker.
+        list(executor.map(
+            _make_box_file,
+            props,
+            out_files,
+            repeat(export_type),
+            repeat(tolerance),
+            repeat(angular_tolerance),
+            repeat(opt)
+        ))
+
+
+def _make_box_file(
+    prop: Properties,
+    out_file: str,
+    export_type: Optional[str],
+    tolerance: float,
+    angular_tolerance: float,
+    opt
+) -> None:
+    make_box(
+        prop,
+        out_file=out_file,
+        export_type=export_type,
+        tolerance=tolerance,
+        angular_tolerance=angular_tolerance,
+        opt=opt,
+        parallel=False
+    )
+
+
 def make_gridfinity_box(wp: Workplane, prop: Properties):
     wp = (
         wp
@@ -386,6 +436,32 @@ def make_gridfinity_box(wp: Workplane, prop: Properties):
     return wp
 
 
+def make_cached_gridfinity_box(prop: Properties, cache_dir: str) -> Workplane:
+    """
+    Returns a workplane holding only the box solid, whether it was read from cache_dir or built and then cached.
+    """
+    key = hashlib.sha1(repr((CACHE_VERSION, astuple(prop))).encode()).hexdigest()
+    path = os.path.join(cache_dir, f'gridfinity_{key}.brep')
+
+    if os.path.exists(path):
+        return cq.Workplane(obj=cq.Shape.importBrep(path))
+
+    box = cq.Workplane(obj=make_gridfinity_box(cq.Workplane(), prop).val())
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write next to the final path and rename, so that a concurrent or interrupted build never leaves a partial file
+    # where another process would read it.
+    fd, tmp_path = tempfile.mkstemp(suffix='.brep', dir=cache_dir)
+    os.close(fd)
+    try:
+        if not box.val().exportBrep(tmp_path):
+            raise OSError(f'Could not write {tmp_path}')
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return box
+
+
 def export_box(
     box: Workplane,
     out_file: Union[str, None] = None,
@@ -393,8 +469,14 @@ def export_box(
                                   'SVG', 'TJS', 'DXF', 'VRML', 'VTP']] = None,
     tolerance: float = 0.1,
     angular_tolerance: float = 0.1,
-    opt=None
+    opt=None,
+    parallel: bool = True
 ) -> Workplane:
+    if (export_type or os.path.splitext(out_file or '')[1][1:]).upper() == 'STL':
+        for shape in box.vals():
+            if isinstance(shape, cq.Shape):
+                BRepMesh_IncrementalMesh(shape.wrapped, tolerance, True, angular_tolerance, parallel)
+
     cq.exporters.export(
         box,
         out_file,
@@ -0,0 +1,41 @@
+from itertools import accumulate
+from typing import List, Tuple
+
+Point = Tuple[float, float]
+Rect = Tuple[float, float, float, float]
+
+
+def compute_bucket_rects(x_mm: float, y_mm: float, wall_thickness: float, rows: List[List[float]]) -> List[Rect]:
+    number_of_y_walls = len(rows) + 1
+    bucket_y = (y_mm - number_of_y_walls * wall_thickness) / len(rows)
+
+    rects = []
+    for row_index, row in enumerate(rows):
+        number_of_x_walls = len(row) + 1
+        bucket_x_per_ratio = (x_mm - number_of_x_walls * wall_thickness) / sum(row)
+        buckets_x = [ratio * bucket_x_per_ratio for ratio in row]
+
+        y_origin = wall_thickness + row_index * (bucket_y + wall_thickness)
+        rects.extend(
+            (wall_thickness + bucket_index * wall_thickness + buckets_before, y_origin, bucket_x, bucket_y)
+            for bucket_index, (bucket_x, buckets_before) in enumerate(zip(buckets_x, accumulate(buckets_x, initial=0)))
+        )
+    return rects
+
+
+def compute_scoop_centers(y: int, y_mm: float, z_mm: float, bottom_thickness: float) -> Tuple[float, List[Point]]:
+    bucket_length = (y_mm - (y + 1)*0.8) / y
+    scoop_radius = min(z_mm * 0.3, bucket_length * 0.9)
+    scoop_x = (
+        scoop_radius / 2 -
+        0.5 * bucket_length * y -
+        y // 2 +
+        (0.5 if y % 2 == 0 else 0)
+    )
+    scoop_y = scoop_radius / 2 - (z_mm - bottom_thickness) / 2
+
+    centers = [
+        (scoop_x + i * (bucket_length + 1) + (1.6 if i == 0 else 0), scoop_y)
+        for i in range(0, y)
+    ]
+    return scoop_radius, centers
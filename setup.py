@@ -6,6 +6,12 @@ setup(
     install_requires=[
         'cadquery2>=2.1.1',
     ],
+    extras_require={
+        'test': [
+            'pytest',
+            'pytest-xdist',
+        ],
+    },
     python_requires='>=3.8.0',
     scripts=[
         'scripts/gridfinity-box.py',
@@ -1,14 +1,32 @@
+import dataclasses
+import functools
+import glob
+import hashlib
+import io
+import math
+import os
+import sys
+import tempfile
 import unittest
+from pathlib import Path
 from typing import Optional
+from unittest import mock
 
-import cadquery2 as cq
-import inspect
+from gridfinity import BOTTOM_THICKNESS, CACHE_VERSION, cq, draw_base, draw_bases, draw_buckets, draw_finger_scoops, \
+    draw_label_ledge, draw_magnet_holes, draw_mate, draw_screw_holes, GridfinityDimension, \
+    make_box, make_boxes, make_cached_gridfinity_box, make_gridfinity_box, Properties, Workplane
+from gridfinity._layout import compute_bucket_rects, compute_scoop_centers
 
-from cadquery2 import Workplane
-
-from gridfinity import draw_base, draw_bases, draw_bucket_sketch, draw_buckets, draw_finger_scoops, draw_label_ledge, \
-    draw_magnet_holes, draw_mate, draw_screw_holes, GridfinityDimension, \
-    make_gridfinity_box, Properties
+# Which files export_for_testing writes: 'svg', 'stl', 'both' or 'none'.
+EXPORT = os.environ.get('GRIDFINITY_EXPORT', 'svg')
+if EXPORT not in ('svg', 'stl', 'both', 'none'):
+    raise ValueError(f"GRIDFINITY_EXPORT must be one of 'svg', 'stl', 'both' or 'none', got {EXPORT!r}")
+# Tessellation tolerances of the exported files. Use 0.1 for both for a fine review.
+TOLERANCE = float(os.environ.get('GRIDFINITY_TOL', '0.5'))
+ANGULAR_TOLERANCE = float(os.environ.get('GRIDFINITY_ATOL', '0.5'))
+# Exported files go next to this module, whatever directory the tests are run from.
+OUTPUT_DIR = Path(__file__).parent
+SNAPSHOT_DIR = OUTPUT_DIR / 'snapshots'
 
 
 class GridfinityDimensionTests(unittest.TestCase):
@@ -20,6 +38,16 @@ class GridfinityDimensionTests(unittest.TestCase):
         )
 
 
+class LayoutTests(unittest.TestCase):
+
+    def test_compute_bucket_rects(self):
+        rects = compute_bucket_rects(100, 50, 1, [[1, 3], [1]])
+        self.assertEqual(
+            rects,
+            [(1, 1, 24.25, 23.5), (26.25, 1, 72.75, 23.5), (1, 25.5, 98, 23.5)]
+        )
+
+
 class PropertiesTests(unittest.TestCase):
 
     properties = Properties(
@@ -38,10 +66,51 @@ class PropertiesTests(unittest.TestCase):
         )
 
 
+def properties_key(properties: Properties) -> tuple:
+    """
+    Returns a hashable copy of properties, as (field name, value) pairs, with lists of divisions turned into tuples.
+    """
+    return tuple(
+        (field.name, _freeze(getattr(properties, field.name)))
+        for field in dataclasses.fields(Properties)
+    )
+
+
+def _freeze(value):
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _thaw(value):
+    if isinstance(value, tuple):
+        return [_thaw(item) for item in value]
+    return value
+
+
+@functools.lru_cache(maxsize=None)
+def _cached_up_to(stage: str, key: tuple) -> Workplane:
+    """
+    Builds the intermediate workplane shared by several tests once. The returned workplane is shared between tests:
+    only pass it to operations that leave their input untouched. draw_screw_holes does not, as it changes the plane
+    of the workplane it is given.
+    """
+    properties = Properties(**{name: _thaw(value) for name, value in key})
+    if stage == 'bases':
+        return draw_bases(cq.Workplane(), properties.dimension, properties.make_magnet_hole)
+    if stage == 'buckets':
+        return draw_buckets(
+            _cached_up_to('bases', key), properties.dimension, properties.divisions, properties.wall_thickness
+        )
+    if stage == 'box':
+        return make_gridfinity_box(cq.Workplane(), properties)
+    raise ValueError('Unknown stage %s' % stage)
+
+
 class MyTestCase(unittest.TestCase):
     """
-    Generates SVG and STL files for the various intermediate operations. Those are expected to be validated
-    manually, no assertions are made during these tests.
+    Generates SVG and / or STL files (see GRIDFINITY_EXPORT) for the various intermediate operations. Those are
+    expected to be validated manually, no assertions are made during these tests.
     """
     properties = Properties(
         GridfinityDimension(2, 3, 4),
@@ -51,63 +120,38 @@ class MyTestCase(unittest.TestCase):
         True,
         False,
         True)
+    key = properties_key(properties)
 
-    def test_draw_bases(self):
-        wp = cq.Workplane()
-        wp = draw_bases(wp, self.properties.dimension, self.properties.make_magnet_hole)
-        export_for_testing(wp)
+    @classmethod
+    def setUpClass(cls):
+        _cached_up_to('buckets', cls.key)
+        cls.box_5 = cq.Workplane().box(cls.properties.dimension.x_mm, cls.properties.dimension.y_mm, 5).val()
+        cls.box_5_6 = cq.Workplane().box(cls.properties.dimension.x_mm, cls.properties.dimension.y_mm, 5.6).val()
 
-    def test_draw_bases_with_magnet_holes(self):
-        wp = cq.Workplane()
-        wp = draw_bases(wp, self.properties.dimension, True)
-        export_for_testing(wp)
+    def test_draw_bases(self):
+        for make_magnet_hole in sorted({self.properties.make_magnet_hole, True}):
+            with self.subTest(make_magnet_hole=make_magnet_hole):
+                wp = cq.Workplane()
+                wp = draw_bases(wp, self.properties.dimension, make_magnet_hole)
+                export_for_testing(wp, 'test_draw_bases_with_magnet_holes' if make_magnet_hole else 'test_draw_bases')
 
     def test_draw_base(self):
         wp = cq.Workplane()
         wp = draw_base(wp, self.properties.make_magnet_hole)
         export_for_testing(wp)
 
-    def test_draw_bucket_sketch(self):
-        wp = cq.Workplane()
-        wp = wp.box(100, 200, 1)
-
-        buckets = []
-
-        bucket = draw_bucket_sketch(
-            x_mm=94, y_mm=95.5,
-            support_x_mm=100, support_y_mm=200,
-            x_origin=3, y_origin=3,
-            wall_thickness=3, small_drawer_width=16
-        )
-        buckets.append(bucket)
-
-        bucket = draw_bucket_sketch(
-            x_mm=94, y_mm=95.5,
-            support_x_mm=100, support_y_mm=200,
-            x_origin=3, y_origin=3 + 95.5 + 3,
-            wall_thickness=3, small_drawer_width=16
-        )
-        buckets.append(bucket)
-
-        wp = wp.placeSketch(*buckets).cutThruAll()
-        export_for_testing(wp)
-
     def test_draw_buckets(self):
-        wp = cq.Workplane()
-        wp = wp.box(self.properties.dimension.x_mm, self.properties.dimension.y_mm, 5.6)
+        wp = cq.Workplane(obj=self.box_5_6)
         wp = draw_buckets(wp, self.properties.dimension, self.properties.divisions, self.properties.wall_thickness)
         export_for_testing(wp)
 
     def test_draw_buckets_thick_walls(self):
-        wp = cq.Workplane()
-        wp = wp.box(self.properties.dimension.x_mm, self.properties.dimension.y_mm, 5.6)
+        wp = cq.Workplane(obj=self.box_5_6)
         wp = draw_buckets(wp, self.properties.dimension, [[3, 4], 5, [2, 1]], 3)
         export_for_testing(wp)
 
     def test_draw_up_to_buckets(self):
-        wp = cq.Workplane()
-        wp = draw_bases(wp, self.properties.dimension, self.properties.make_magnet_hole)
-        wp = draw_buckets(wp, self.properties.dimension, self.properties.divisions, self.properties.wall_thickness)
+        wp = _cached_up_to('buckets', self.key)
         export_for_testing(wp)
 
     def test_draw_finger_scoops(self):
@@ -117,9 +161,7 @@ class MyTestCase(unittest.TestCase):
         export_for_testing(wp)
 
     def test_draw_up_to_finger_scoops(self):
-        wp = cq.Workplane()
-        wp = draw_bases(wp, self.properties.dimension, self.properties.make_magnet_hole)
-        wp = draw_buckets(wp, self.properties.dimension, self.properties.divisions, self.properties.wall_thickness)
+        wp = _cached_up_to('buckets', self.key)
         wp = draw_finger_scoops(wp, self.properties.dimension)
         export_for_testing(wp)
 
@@ -130,9 +172,7 @@ class MyTestCase(unittest.TestCase):
         export_for_testing(wp)
 
     def test_draw_up_to_label_ledge(self):
-        wp = cq.Workplane()
-        wp = draw_bases(wp, self.properties.dimension, self.properties.make_magnet_hole)
-        wp = draw_buckets(wp, self.properties.dimension, self.properties.divisions, self.properties.wall_thickness)
+        wp = _cached_up_to('buckets', self.key)
         wp = draw_label_ledge(wp, self.properties.dimension, self.properties.wall_thickness)
         export_for_testing(wp)
 
@@ -143,34 +183,27 @@ class MyTestCase(unittest.TestCase):
         export_for_testing(wp)
 
     def test_draw_up_to_mate(self):
-        wp = cq.Workplane()
-        wp = draw_bases(wp, self.properties.dimension, self.properties.make_magnet_hole)
-        wp = draw_buckets(wp, self.properties.dimension, self.properties.divisions, self.properties.wall_thickness)
+        wp = _cached_up_to('buckets', self.key)
         wp = draw_mate(wp, self.properties.dimension)
         export_for_testing(wp)
 
     def test_draw_magnet_holes(self):
-        wp = cq.Workplane()
-        wp = wp.box(self.properties.dimension.x_mm, self.properties.dimension.y_mm, 5)
+        wp = cq.Workplane(obj=self.box_5)
         wp = draw_magnet_holes(wp)
         export_for_testing(wp)
 
     def test_draw_up_to_magnet_holes(self):
-        wp = cq.Workplane()
-        wp = draw_bases(wp, self.properties.dimension, self.properties.make_magnet_hole)
-        wp = draw_buckets(wp, self.properties.dimension, self.properties.divisions, self.properties.wall_thickness)
+        wp = _cached_up_to('buckets', self.key)
         wp = draw_magnet_holes(wp)
         export_for_testing(wp)
 
     def test_draw_screw_holes(self):
-        wp = cq.Workplane()
-        wp = wp.box(self.properties.dimension.x_mm, self.properties.dimension.y_mm, 5)
+        wp = cq.Workplane(obj=self.box_5)
         wp = draw_screw_holes(wp)
         export_for_testing(wp)
 
     def test_make_gridfinity_box(self):
-        wp = cq.Workplane()
-        wp = make_gridfinity_box(wp, self.properties)
+        wp = _cached_up_to('box', self.key)
         export_for_testing(wp)
 
     def test_minimal_box(self):
@@ -182,20 +215,133 @@ class MyTestCase(unittest.TestCase):
         export_for_testing(wp, 'gridfinity_bin_{dimension.x}x{dimension.y}x{dimension.z}'.format(dimension=dimension))
 
 
+class BoxTests(unittest.TestCase):
+    """
+    Checks the geometry and the files produced by the drawing and box building functions with assertions.
+    """
+    properties = MyTestCase.properties
+    key = MyTestCase.key
+
+    def test_draw_finger_scoops_tall_bin(self):
+        dimension = GridfinityDimension(1, 3, 12)
+        scoop_radius, _ = compute_scoop_centers(dimension.y, dimension.y_mm, dimension.z_mm, BOTTOM_THICKNESS)
+        box = cq.Workplane().box(1, dimension.y_mm, dimension.z_mm)
+        wp = draw_finger_scoops(box, dimension)
+
+        scoop_volume = (1 - math.pi / 4) * scoop_radius ** 2 * (dimension.x_mm - 0.8)
+        self.assertAlmostEqual(
+            wp.val().Volume() - box.val().Volume(),
+            dimension.y * scoop_volume,
+            delta=scoop_volume * 1e-3
+        )
+
+    def test_make_cached_gridfinity_box(self):
+        box = _cached_up_to('box', self.key)
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                mock.patch('gridfinity.make_gridfinity_box', return_value=box) as make_gridfinity_box_mock:
+            first = make_cached_gridfinity_box(self.properties, cache_dir)
+            self.assertEqual(len(glob.glob(os.path.join(cache_dir, 'gridfinity_*.brep'))), 1)
+
+            second = make_cached_gridfinity_box(self.properties, cache_dir)
+            make_gridfinity_box_mock.assert_called_once()
+
+        self.assertAlmostEqual(second.val().Volume(), first.val().Volume(), delta=first.val().Volume() * 1e-6)
+        self.assertEqual(len(first.vals()), 1)
+        self.assertEqual(len(second.vals()), 1)
+
+    def test_make_cached_gridfinity_box_version(self):
+        box = _cached_up_to('box', self.key)
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                mock.patch('gridfinity.make_gridfinity_box', return_value=box) as make_gridfinity_box_mock:
+            make_cached_gridfinity_box(self.properties, cache_dir)
+            with mock.patch('gridfinity.CACHE_VERSION', CACHE_VERSION + 1):
+                make_cached_gridfinity_box(self.properties, cache_dir)
+            self.assertEqual(make_gridfinity_box_mock.call_count, 2)
+
+    def test_make_cached_gridfinity_box_write_failure(self):
+        box = _cached_up_to('box', self.key)
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                mock.patch('gridfinity.make_gridfinity_box', return_value=box), \
+                mock.patch.object(cq.Shape, 'exportBrep', return_value=False):
+            with self.assertRaises(OSError):
+                make_cached_gridfinity_box(self.properties, cache_dir)
+            self.assertEqual(os.listdir(cache_dir), [])
+
+    def test_make_boxes(self):
+        props = [
+            Properties(GridfinityDimension(1, 1, 3), [1], 0.8, False, False, False, False),
+            Properties(GridfinityDimension(1, 2, 3), [1, 2], 0.8, False, False, False, False),
+        ]
+        with tempfile.TemporaryDirectory() as out_dir:
+            out_files = [os.path.join(out_dir, '%s.stl' % prop) for prop in props]
+            make_boxes(props, out_files, max_workers=2)
+            for out_file in out_files:
+                self.assertTrue(os.path.getsize(out_file) > 0)
+
+    def test_make_boxes_after_parallel_mesh(self):
+        props = [
+            Properties(GridfinityDimension(1, 1, 3), [1], 0.8, False, False, False, False),
+            Properties(GridfinityDimension(1, 2, 3), [1, 2], 0.8, False, False, False, False),
+        ]
+        with tempfile.TemporaryDirectory() as out_dir:
+            make_box(props[0], os.path.join(out_dir, 'parent.stl'))
+            out_files = [os.path.join(out_dir, f'{prop}.stl') for prop in props]
+            make_boxes(props, out_files, max_workers=2)
+            for out_file in out_files:
+                self.assertTrue(os.path.getsize(out_file) > 0)
+
+    def test_make_boxes_length_mismatch(self):
+        props = [Properties(GridfinityDimension(1, 1, 3), [1], 0.8, False, False, False, False)]
+        with self.assertRaises(ValueError):
+            make_boxes(props, ['a.stl', 'b.stl'])
+
+
 def export_for_testing(wp: Workplane, name: Optional[str] = None) -> None:
     if name is None:
-        name = inspect.getframeinfo(inspect.currentframe().f_back).function
-    export_svg(wp, name)
+        name = sys._getframe(1).f_code.co_name
+    if EXPORT in ('svg', 'both'):
+        export_svg(wp, name)
+    if EXPORT == 'stl':
+        export_stl(wp, name)
+    elif EXPORT == 'both':
+        export_stl_if_changed(wp, name)
+
+
+def export_stl_if_changed(wp: Workplane, name: str) -> None:
+    """
+    Only regenerates the STL when the geometry digest of wp differs from the one recorded for name, or when the STL is
+    missing. The digest is recorded once the STL has been written.
+    """
+    digest = geometry_digest(wp)
+    snapshot = SNAPSHOT_DIR / f'{name}.hash'
+    if (OUTPUT_DIR / f'{name}.stl').exists() and snapshot.exists() and snapshot.read_text() == digest:
+        return
     export_stl(wp, name)
+    SNAPSHOT_DIR.mkdir(exist_ok=True)
+    snapshot.write_text(digest)
+
+
+def geometry_digest(wp: Workplane) -> str:
+    """
+    Hashes the BREP of the shapes of wp together with the tessellation tolerances, which is everything the STL depends
+    on. The shapes are copied first, as BREP output includes any triangulation left on them by earlier exports.
+    """
+    digest = hashlib.blake2b(f'{TOLERANCE} {ANGULAR_TOLERANCE}'.encode())
+    for shape in wp.vals():
+        if isinstance(shape, cq.Shape):
+            brep = io.BytesIO()
+            shape.copy().exportBrep(brep)
+            digest.update(brep.getvalue())
+    return digest.hexdigest()
 
 
 def export_svg(wp: Workplane, name: str) -> None:
     cq.exporters.export(
         wp,
-        '%s.svg' % name,
+        str(OUTPUT_DIR / f'{name}.svg'),
         exportType='SVG',
-        tolerance=0.1,
-        angularTolerance=0.1,
+        tolerance=TOLERANCE,
+        angularTolerance=ANGULAR_TOLERANCE,
         opt={
             'showAxes': False,
             'marginLeft': 10,
@@ -209,10 +355,10 @@ def export_svg(wp: Workplane, name: str) -> None:
 def export_stl(wp: Workplane, name: str) -> None:
     cq.exporters.export(
         wp,
-        '%s.stl' % name,
+        str(OUTPUT_DIR / f'{name}.stl'),
         exportType='STL',
-        tolerance=0.1,
-        angularTolerance=0.1,
+        tolerance=TOLERANCE,
+        angularTolerance=ANGULAR_TOLERANCE,
     )
 
 